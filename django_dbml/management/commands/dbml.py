@@ -1,9 +1,14 @@
 # ruff: noqa: SLF001
 import hashlib
 import inspect
+import io
 import logging
+import os
+import shutil
+from contextlib import contextmanager, nullcontext, suppress
 from datetime import UTC, datetime
 from functools import cache
+from operator import itemgetter
 from pathlib import Path
 from textwrap import dedent
 
@@ -13,13 +18,95 @@ from django.contrib.postgres.indexes import HashIndex
 from django.core.management.base import BaseCommand, CommandError
 from django.db import connection, models
 from django.db.models import Model
-from django.db.models.fields import Field
+from django.db.models.fields import NOT_PROVIDED, Field
 
 from django_dbml.utils import to_snake_case
 
 
 logger = logging.getLogger('dbml')
 
+# Translation tables for the quote escaping applied to notes
+escape_double_quotes = str.maketrans({'"': '\\"'})
+single_to_double_quotes = str.maketrans({"'": '"'})
+
+# Field entry keys that get_field_attributes() renders elsewhere, and keys rendered as bare flags
+skipped_field_attributes = frozenset({'type', 'null'})
+flag_field_attributes = frozenset({'pk', 'unique'})
+# Field entry keys of a column that renders as just null / not null, as long as its note is empty
+plain_field_attributes = frozenset({'type', 'note', 'null'})
+
+# Field classes shipped with Django, their dbml types are resolved up front in handle()
+builtin_field_classes = tuple(value for value in vars(models).values() if isinstance(value, type) and issubclass(value, Field))
+
+
+def format_note_attribute(value: str) -> str:
+    """Returns the dbml note attribute for a field note, or an empty string if there is no note."""
+    if not value:
+        return ""
+
+    value_formatted = value.translate(single_to_double_quotes)
+    if '\n' in value_formatted:
+        return f"note: '''\n{value_formatted}'''"
+    return f"note: '''{value_formatted}'''"
+
+
+@cache
+def callable_default_repr(value) -> str:
+    """Returns the dotted call a callable default is shown as, inspect.getmodule() is slow so the result is cached."""
+    module = inspect.getmodule(value)
+    return f'{module.__name__}.{value.__name__}()' if module else f'{value.__name__}()'
+
+
+def format_default_attribute(value) -> str:
+    """Returns the dbml default attribute for a field default."""
+    if callable(value):
+        try:
+            value = callable_default_repr(value)
+        except TypeError:  # unhashable callables can not be cached
+            value = callable_default_repr.__wrapped__(value)
+    elif isinstance(value, str):
+        value = f'"{value}"'
+    return f'default:`{value}`'
+
+
+# Field entry keys whose dbml attribute is rendered by a dedicated formatter
+field_attribute_formatters = {'note': format_note_attribute, 'default': format_default_attribute}
+
+# The dbml reference operator for each type of relation
+relation_symbols = {'one_to_many': '>', 'one_to_one': '-'}
+
+# Substrings of a database ENGINE setting, and the name dbml uses for that database type
+database_types = (
+    ('postgres', 'PostgreSQL'),
+    ('sqlite', 'SQLite'),
+    ('mysql', 'MySQL'),
+    ('oracle', 'Oracle'),
+    ('mssql', 'Microsoft SQL'),
+)
+
+
+@contextmanager
+def replace_file_on_success(path: Path):
+    """Yields a file next to path to write to, which only replaces path once the with block completes without error."""
+    path = path.resolve()  # write through a symlink rather than replacing the link itself
+
+    if path.exists() and not os.access(path.parent, os.W_OK):
+        # No temporary file can be created in a read-only directory, but the existing file can still be overwritten
+        with path.open('w', encoding="utf-8", buffering=1 << 16) as f:
+            yield f
+        return
+
+    temp_path = path.with_name(f'.{path.name}.{os.getpid()}.tmp')
+    try:
+        with temp_path.open('w', encoding="utf-8", buffering=1 << 16) as f:
+            yield f
+
+        with suppress(FileNotFoundError):  # keep the permissions of an existing file
+            shutil.copymode(path, temp_path)
+        os.replace(temp_path, path)
+    finally:
+        temp_path.unlink(missing_ok=True)  # only still there if writing or replacing failed
+
 
 class Command(BaseCommand):
     help = "Generate a DBML file based on Django models"
@@ -34,41 +121,33 @@ class Command(BaseCommand):
         parser.add_argument("--add_project_notes", action="store", help="add notes to describe the project")
         parser.add_argument("--disable_update_timestamp", action="store_true", help="do not include a 'Last updated at' timestamp in the project notes.")
         parser.add_argument("--output_file", action="store", help="Put the generated schema in this file, rather than printing it to stdout.")
+        parser.add_argument("--deduplicate_enums", action="store_true", help="Emit a single enum for fields of the same type that share the same choices.")
         # fmt: on
 
-    def get_field_attributes(self, field: dict) -> str:  # noqa: PLR0912
+    def get_field_attributes(self, field: dict) -> str:
         """Returns a string with the supported dbml attributes of a given field."""
 
-        if len(field.keys()) == 1:
+        if len(field) == 1:
             return ""
 
+        # Most columns only carry their nullability, render those without walking the entry
+        if not field.get('note') and field.keys() <= plain_field_attributes:
+            return '[null]' if field.get('null') else '[not null]'
+
         attributes = []
         for name, value in field.items():
-            if name in {"type", "null"}:
-                continue
-
-            if name == "note":
-                if value:
-                    value_formatted = value.replace("'", '"')
-                    if '\n' in value_formatted:
-                        attributes.append(f"note: '''\n{value_formatted}'''")
-                    else:
-                        attributes.append(f"note: '''{value_formatted}'''")
+            if name in skipped_field_attributes:
                 continue
 
-            if name in {"pk", "unique"}:
+            formatter = field_attribute_formatters.get(name)
+            if formatter is not None:
+                formatted = formatter(value)
+                if formatted:
+                    attributes.append(formatted)
+            elif name in flag_field_attributes:
                 attributes.append(name)
-                continue
-
-            if name == "default":
-                if callable(value):
-                    value = f'{inspect.getmodule(value).__name__}.{value.__name__}()' if inspect.getmodule(value) else f'{value.__name__}()'  # noqa: PLW2901
-                elif isinstance(value, str):
-                    value = f'"{value}"'  # noqa: PLW2901
-                attributes.append(f'default:`{value}`')
-                continue
-
-            attributes.append(f"{name}:{value}")
+            else:
+                attributes.append(f"{name}:{value}")
 
         if field.get('null'):
             attributes.append('null')
@@ -77,21 +156,29 @@ class Command(BaseCommand):
 
         if not attributes:
             return ""
-        return "[{}]".format(", ".join(attributes))
+        return f"[{', '.join(attributes)}]"
 
     def get_table_name(self, model: Model) -> str:
         """Return the name to use in dbml for the given model."""
 
+        # Every relation looks up the name of the model on its other end, so remember the names already computed during this run
+        table_name = self._table_name_cache.get(model)
+        if table_name is not None:
+            return table_name
+
         if self.options["table_names"]:
-            return model._meta.db_table
+            table_name = model._meta.db_table
+        else:
+            # Use the "<app_name>.<model_name>" format, to avoid clashes with the same model names being used in different apps.
+            table_name = model._meta.label
 
-        # Return the "<app_name>.<model_name>" format, to avoid clashes with the same model names being used in different apps.
-        return model._meta.label
+        self._table_name_cache[model] = table_name
+        return table_name
 
     def get_enum_choices(self, field: Field) -> list:
         """Returns the value and display_value for choices on a field."""
 
-        return list(field.choices)
+        return field.choices
 
     def get_app_tables(self, app_labels) -> list:
         """Get the list of models to generate DBML for."""
@@ -103,17 +190,13 @@ class Command(BaseCommand):
         # get specific models when app or app.model is specified
         app_tables = []
         for app in app_labels:
-            app_label_parts = app.split('.')
-            # first part is always the app label
-            app_label = app_label_parts[0]
-            # use the second part as model label if set
-            model_label = app_label_parts[1] if len(app_label_parts) > 1 else None
+            # first part is always the app label, use the second part as model label if set
+            app_label, _, model_label = app.partition('.')
             try:
                 app_config = apps.get_app_config(app_label)
             except LookupError as e:
                 raise CommandError(str(e))  # noqa: B904
 
-            app_config = apps.get_app_config(app_label)
             if model_label:
                 app_tables.append(app_config.get_model(model_label))
             else:
@@ -121,34 +204,30 @@ class Command(BaseCommand):
 
         return app_tables
 
+    @cache  # noqa: B019
     def get_tl_module_name(self, model: Model) -> str:
         """Get top level module of model."""
 
-        parts = model.__module__.split(".")
+        package, _, module = model.__module__.rpartition(".")
 
         # Return the name of the app this model belongs to, if possible
-        if len(parts) >= 2:  # noqa: PLR2004
-            return parts[-2]
+        if package:
+            return package.rpartition(".")[2]
 
-        return parts[0]
+        return module
+
+    @cache  # noqa: B019
+    def get_app_color(self, tl_module_name: str) -> str:
+        """Return the header color used for the tables of a top level module."""
+        return f"#{hashlib.sha256(tl_module_name.encode()).hexdigest()[:6]}"
 
     def get_db_type(self) -> str:
         """Return which type of database is being used."""
 
-        db = settings.DATABASES['default']
-
-        if 'postgres' in db['ENGINE'].lower():
-            return 'PostgreSQL'
-        if 'sqlite' in db['ENGINE'].lower():
-            return 'SQLite'
-        if 'mysql' in db['ENGINE'].lower():
-            return 'MySQL'
-        if 'oracle' in db['ENGINE'].lower():
-            return 'Oracle'
-        if 'mssql' in db['ENGINE'].lower():
-            return 'Microsoft SQL'
+        engine = settings.DATABASES['default']['ENGINE']
+        engine_lower = engine.lower()
 
-        return "Unknown ({})".format(db['ENGINE'])
+        return next((name for key, name in database_types if key in engine_lower), f"Unknown ({engine})")
 
     @cache  # noqa: B019
     def map_field_type_to_dbml_type(self, field: type[Field]) -> str:
@@ -172,194 +251,199 @@ class Command(BaseCommand):
 
     def handle(self, *app_labels, **kwargs):  # noqa: D102, PLR0912, PLR0914, PLR0915
         self.options = kwargs
+        self._table_name_cache = {}
         project_name = self.options["add_project_name"]
         project_notes = self.options["add_project_notes"]
+        use_table_names = self.options["table_names"]
+        color_by_app = self.options["color_by_app"]
+        group_by_app = self.options["group_by_app"]
+        deduplicate_enums = self.options["deduplicate_enums"]
 
-        ignore_types = (models.fields.reverse_related.ManyToOneRel, models.fields.reverse_related.ManyToManyRel)
+        # A single schema editor is enough to derive all index and constraint names
+        schema_editor = connection.schema_editor()
+        create_index_name = schema_editor._create_index_name
+        unique_constraint_name = schema_editor._unique_constraint_name  # returns an IndexName reference, so callers convert it with str()
 
         # Collect information on all models
 
-        enums, tables, table_colors_and_groups = {}, {}, {}
+        get_table_name = self.get_table_name
+        dbml_types = {field_class: self.map_field_type_to_dbml_type(field_class) for field_class in builtin_field_classes}
+        # table_colors and table_groups map a table name to its header color and TableGroup
+        enums, tables, table_colors, table_groups = {}, {}, {}, {}
+        enum_names_by_choices = {}
 
         for app_table in self.get_app_tables(app_labels):
             tl_module_name = self.get_tl_module_name(app_table)
 
-            table_color = "" if not self.options["color_by_app"] else f"#{hashlib.sha256(tl_module_name.encode()).hexdigest()[:6]}"
+            table_color = self.get_app_color(tl_module_name) if color_by_app else ""
 
-            table_name = self.get_table_name(app_table)
-            tables[table_name] = {"fields": {}, "relations": [], 'indexes': [], 'note': ''}
-            table_colors_and_groups[table_name] = {"color": table_color, "group": tl_module_name}
+            opts = app_table._meta
+            db_table = opts.db_table
 
-            for field in app_table._meta.get_fields():
-                if isinstance(field, ignore_types):
-                    continue
+            table_name = get_table_name(app_table)
+            # relations are (type, table_to, table_to_field, table_from, table_from_field) tuples
+            table_entry = tables[table_name] = {"fields": {}, "relations": [], 'indexes': [], 'note': ''}
+            if color_by_app:
+                table_colors[table_name] = table_color
+            if group_by_app:
+                table_groups[table_name] = tl_module_name
 
+            # Only concrete fields have a column in the table, reverse relations are described by the field on the other model.
+            # These are all Field instances, so the common Field attributes can be read without probing for them.
+            for field in opts.concrete_fields:
                 field_name = field.name
 
-                field_attributes = list(dir(field))
-
-                # print(table_name, field, type(field))
-                if isinstance(field, models.fields.related.OneToOneField):
+                if field.one_to_one or field.many_to_one:
                     field_name += '_id'  # the db column name always has this suffix added
 
-                    tables[table_name]["relations"].append(
-                        {
-                            "type": "one_to_one",
-                            "table_from": self.get_table_name(field.related_model),
-                            "table_from_field": field.target_field.name,
-                            "table_to": table_name,
-                            "table_to_field": field_name,
-                        }
-                    )
-
-                elif isinstance(field, models.fields.related.ForeignKey):
-                    field_name += '_id'  # the db column name always has this suffix added
-
-                    tables[table_name]["relations"].append(
-                        {
-                            "type": "one_to_many",
-                            "table_from": self.get_table_name(field.related_model),
-                            "table_from_field": field.target_field.name,
-                            "table_to": table_name,
-                            "table_to_field": field_name,
-                        }
-                    )
+                    relation_type = "one_to_one" if field.one_to_one else "one_to_many"
+                    table_entry["relations"].append((relation_type, table_name, field_name, get_table_name(field.related_model), field.target_field.name))
 
-                elif isinstance(field, models.fields.related.ManyToManyField):
-                    table_name_m2m: str = field.m2m_db_table()
-
-                    # If there is no underscore in the through model, we assume it is explicitly specified by the user via the 'through' attribute on the M2M field.
-                    # If it is specified, the through model will already have been included in the schema on its own when looping over the app_tables.
-                    # So in that case, we do not want to have a separate, additional model here, since that model will never actually be used.
-                    # (it would represent the autogenerated m2m intermediate model, but we are defining our own through model instead).
-                    if '_' not in field.remote_field.through._meta.model_name:
-                        continue
-
-                    # If we reach here, we are dealing with a django-autogenerated m2m linking table.
-                    # We should replace the name by a name which include the relevant app.
-                    # If we don't do that, it would claim that this table is in a 'public' db schema, which is not true.
-                    # It should belong with the app where the other models live.
-
-                    old_table_name_m2m = table_name_m2m
-                    if '_' in table_name_m2m:
-                        table_name_m2m = table_name_m2m.replace('_', '.', 1)
-
-                    # only define m2m table and relations on first encounter
-                    if table_name_m2m not in tables:
-                        tables[table_name_m2m] = {"fields": {}, "relations": [], 'indexes': [], 'note': ''}
-                        # keep the color of the table for the m2m
-                        table_colors_and_groups[table_name_m2m] = {"color": table_color, "group": tl_module_name}
-
-                        tables[table_name_m2m]["relations"].append(
-                            {
-                                "type": "one_to_many",
-                                "table_from": table_name_m2m,
-                                "table_from_field": field.m2m_column_name(),
-                                "table_to": self.get_table_name(field.model),
-                                "table_to_field": field.m2m_target_field_name(),
-                            }
-                        )
-                        tables[table_name_m2m]["relations"].append(
-                            {
-                                "type": "one_to_many",
-                                "table_from": table_name_m2m,
-                                "table_from_field": field.m2m_reverse_name(),
-                                "table_to": self.get_table_name(field.related_model),
-                                "table_to_field": field.m2m_reverse_target_field_name(),
-                            }
-                        )
-                        tables[table_name_m2m]["fields"]['id'] = {"pk": True, "type": "auto"}
-                        tables[table_name_m2m]["fields"][field.m2m_reverse_name()] = {"type": "auto"}
-                        tables[table_name_m2m]["fields"][field.m2m_column_name()] = {"type": "auto"}
-
-                        tables[table_name_m2m]['note'] = 'This is a Many-To-Many linking table autogenerated by Django.'
-                        if not self.options["table_names"]:
-                            tables[table_name_m2m]["note"] += f"\n\n*DB table: {old_table_name_m2m}*"
-
-                        for f_name in [field.m2m_reverse_name(), field.m2m_column_name()]:
-                            tables[table_name_m2m]['indexes'].append(
-                                {
-                                    'fields': [f_name],
-                                    'type': 'btree',
-                                    'name': connection.schema_editor()._create_index_name(old_table_name_m2m, [f_name]),
-                                    'unique': False,
-                                    'pk': False,
-                                }
-                            )
-                        tables[table_name_m2m]['indexes'].append(
-                            {'fields': ['id'], 'type': 'btree', 'name': f'{old_table_name_m2m}_pkey', 'unique': True, 'pk': True}
-                        )
-                        tables[table_name_m2m]["indexes"].append(
-                            {
-                                'fields': [field.m2m_column_name(), field.m2m_reverse_name()],
-                                'type': 'btree',
-                                'name': connection.schema_editor()._unique_constraint_name(
-                                    old_table_name_m2m, [field.m2m_column_name(), field.m2m_reverse_name()], quote=False
-                                ),
-                                'unique': True,
-                                'pk': False,
-                            }
-                        )
+                field_type = dbml_types.get(type(field))
+                if field_type is None:
+                    field_type = dbml_types[type(field)] = self.map_field_type_to_dbml_type(type(field))
 
-                    continue
+                field_entry = {"type": field_type, 'note': ''}
+                note_parts = []
 
-                tables[table_name]["fields"][field_name] = {"type": self.map_field_type_to_dbml_type(type(field)), 'note': ''}
+                db_comment = field.db_comment
+                if db_comment:
+                    note_parts.append(db_comment.translate(escape_double_quotes))
 
-                if "db_comment" in field_attributes and field.db_comment:
-                    tables[table_name]["fields"][field_name]["note"] += field.db_comment.replace('"', '\\"')
+                help_text = field.help_text
+                if help_text:
+                    note_parts.append(help_text.translate(escape_double_quotes))
 
-                if "help_text" in field_attributes and field.help_text:
-                    help_text = field.help_text.replace('"', '\\"')
-                    tables[table_name]["fields"][field_name]["note"] += f"\n{help_text}"
+                if field.null is True:
+                    field_entry["null"] = True
 
-                if "null" in field_attributes and field.null is True:
-                    tables[table_name]["fields"][field_name]["null"] = True
+                primary_key = field.primary_key
+                unique = field.unique  # a property on Field, derived from _unique and primary_key
 
-                if "primary_key" in field_attributes and field.primary_key is True:
-                    tables[table_name]["fields"][field_name]["pk"] = True
+                if primary_key is True:
+                    field_entry["pk"] = True
 
-                if "db_index" in field_attributes and (field.db_index or field.primary_key or field.unique):
-                    if field.primary_key:
-                        index_name = f'{app_table._meta.db_table}_pkey'
-                    elif isinstance(field, models.fields.related.OneToOneField) or field.unique:
-                        index_name = f'{app_table._meta.db_table}_{field_name}_key'
+                if field.db_index or primary_key or unique:
+                    if primary_key:
+                        index_name = f'{db_table}_pkey'
+                    elif field.one_to_one or unique:
+                        index_name = f'{db_table}_{field_name}_key'
                     else:
-                        index_name = connection.schema_editor()._create_index_name(app_table._meta.db_table, [field_name])
+                        index_name = create_index_name(db_table, [field_name])
 
-                    tables[table_name]['indexes'].append(
-                        {'fields': [field_name], 'type': 'btree', 'name': index_name, 'unique': field.unique, 'pk': field.primary_key}
+                    table_entry['indexes'].append(
+                        {'fields': [field_name], 'type': 'btree', 'name': index_name, 'unique': unique, 'pk': primary_key}
                     )
 
-                if "unique" in field_attributes and field.unique is True:
-                    tables[table_name]["fields"][field_name]["unique"] = True
+                if unique is True:
+                    field_entry["unique"] = True
 
-                if "default" in field_attributes and field.default != models.fields.NOT_PROVIDED:
-                    tables[table_name]["fields"][field_name]["default"] = field.default
+                default = field.default
+                if default != NOT_PROVIDED:
+                    field_entry["default"] = default
 
-                if 'choices' in field_attributes and field.choices:
+                if field.choices:
                     if '.' in table_name:
                         schema_name, model_name = table_name.split('.')
                     elif '_' in table_name:
                         schema_name, model_name = table_name.split('_')
 
-                    enum_name = f'{schema_name}.{tables[table_name]["fields"][field_name]["type"]}_{model_name}_{field_name}'.lower()
+                    enum_name = f'{schema_name}.{field_entry["type"]}_{model_name}_{field_name}'.lower()
+                    choices = self.get_enum_choices(field)
+
+                    if deduplicate_enums:
+                        with suppress(TypeError):  # grouped choices contain lists, which can not be part of a key
+                            enum_name = enum_names_by_choices.setdefault((field_entry['type'], tuple(choices)), enum_name)
+
+                    field_entry['type'] = enum_name
+                    if not deduplicate_enums or enum_name not in enums:
+                        enums[enum_name] = '\n  '.join(f"\"{value}\" [note: '''{display}''']" for value, display in choices)
 
-                    tables[table_name]["fields"][field_name]['type'] = enum_name
-                    enums[enum_name] = '\n  '.join([f"\"{c[0]}\" [note: '''{c[1]}''']" for c in self.get_enum_choices(field)])
+                if hasattr(field, 'base_field') and field.base_field.choices:
+                    note_parts.append(f'\nBase field choices ({self.map_field_type_to_dbml_type(type(field.base_field))}):')
+                    note_parts.append(self.choices_to_markdown_table(field.base_field.choices))
 
-                if 'base_field' in field_attributes and field.base_field.choices:
-                    tables[table_name]["fields"][field_name]["note"] += f'\n\nBase field choices ({self.map_field_type_to_dbml_type(type(field.base_field))}):'
-                    tables[table_name]["fields"][field_name]["note"] += f'\n{self.choices_to_markdown_table(field.base_field.choices)}'
+                field_entry["note"] = '\n'.join(note_parts).strip('\n')
+                table_entry["fields"][field_name] = field_entry
 
-                tables[table_name]["fields"][field_name]["note"] = tables[table_name]["fields"][field_name]["note"].strip('\n')
+            # Many-to-many fields have no column of their own, they are stored in a linking table
+            for field in opts.many_to_many:
+                table_name_m2m: str = field.m2m_db_table()
+
+                # If there is no underscore in the through model, we assume it is explicitly specified by the user via the 'through' attribute on the M2M field.
+                # If it is specified, the through model will already have been included in the schema on its own when looping over the app_tables.
+                # So in that case, we do not want to have a separate, additional model here, since that model will never actually be used.
+                # (it would represent the autogenerated m2m intermediate model, but we are defining our own through model instead).
+                if '_' not in field.remote_field.through._meta.model_name:
+                    continue
+
+                # If we reach here, we are dealing with a django-autogenerated m2m linking table.
+                # We should replace the name by a name which include the relevant app.
+                # If we don't do that, it would claim that this table is in a 'public' db schema, which is not true.
+                # It should belong with the app where the other models live.
+
+                old_table_name_m2m = table_name_m2m
+                if '_' in table_name_m2m:
+                    table_name_m2m = table_name_m2m.replace('_', '.', 1)
+
+                # only define m2m table and relations on first encounter
+                if table_name_m2m not in tables:
+                    m2m_column = field.m2m_column_name()
+                    m2m_reverse = field.m2m_reverse_name()
+                    model_table_name = get_table_name(field.model)
+                    related_table_name = get_table_name(field.related_model)
+
+                    m2m_entry = tables[table_name_m2m] = {"fields": {}, "relations": [], 'indexes': [], 'note': ''}
+                    # keep the color of the table for the m2m
+                    if color_by_app:
+                        table_colors[table_name_m2m] = table_color
+                    if group_by_app:
+                        table_groups[table_name_m2m] = tl_module_name
+
+                    m2m_entry["relations"].append(("one_to_many", model_table_name, field.m2m_target_field_name(), table_name_m2m, m2m_column))
+                    m2m_entry["relations"].append(("one_to_many", related_table_name, field.m2m_reverse_target_field_name(), table_name_m2m, m2m_reverse))
+                    m2m_entry["fields"]['id'] = {"pk": True, "type": "auto"}
+                    m2m_entry["fields"][m2m_reverse] = {"type": "auto"}
+                    m2m_entry["fields"][m2m_column] = {"type": "auto"}
+
+                    m2m_note = ['This is a Many-To-Many linking table autogenerated by Django.']
+                    if not use_table_names:
+                        m2m_note.append(f"*DB table: {old_table_name_m2m}*")
+                    m2m_entry['note'] = '\n\n'.join(m2m_note)
+
+                    m2m_entry['indexes'].extend([
+                        {
+                            'fields': [m2m_reverse],
+                            'type': 'btree',
+                            'name': create_index_name(old_table_name_m2m, [m2m_reverse]),
+                            'unique': False,
+                            'pk': False,
+                        },
+                        {
+                            'fields': [m2m_column],
+                            'type': 'btree',
+                            'name': create_index_name(old_table_name_m2m, [m2m_column]),
+                            'unique': False,
+                            'pk': False,
+                        },
+                        {'fields': ['id'], 'type': 'btree', 'name': f'{old_table_name_m2m}_pkey', 'unique': True, 'pk': True},
+                        {
+                            'fields': [m2m_column, m2m_reverse],
+                            'type': 'btree',
+                            'name': str(unique_constraint_name(old_table_name_m2m, [m2m_column, m2m_reverse], quote=False)),
+                            'unique': True,
+                            'pk': False,
+                        },
+                    ])
 
             # Indexes declared on individual fields have been added while looping over the fields above.
             # Here, add indices from class Meta: indexes and unique_together
-            if app_table._meta.indexes:
-                for index in app_table._meta.indexes:
-                    column_names_in_index = [app_table._meta._forward_fields_map[field].column for field in index.fields]
+            forward_fields_map = opts._forward_fields_map
+            if opts.indexes:
+                for index in opts.indexes:
+                    column_names_in_index = [forward_fields_map[field].column for field in index.fields]
 
-                    tables[table_name]["indexes"].append(
+                    table_entry["indexes"].append(
                         {
                             'fields': column_names_in_index,
                             'type': 'btree' if not isinstance(index, HashIndex) else 'hash',
@@ -368,108 +452,105 @@ class Command(BaseCommand):
                             'pk': False,
                         }
                     )
-            if app_table._meta.unique_together:
-                for unique_together in app_table._meta.unique_together:
-                    column_names_in_index = [app_table._meta._forward_fields_map[field].column for field in unique_together]
+            if opts.unique_together:
+                for unique_together in opts.unique_together:
+                    column_names_in_index = [forward_fields_map[field].column for field in unique_together]
 
-                    tables[table_name]["indexes"].append(
+                    table_entry["indexes"].append(
                         {
                             'fields': column_names_in_index,
                             'type': 'btree',
-                            'name': connection.schema_editor()._unique_constraint_name(app_table._meta.db_table, column_names_in_index, quote=False),
+                            'name': str(unique_constraint_name(db_table, column_names_in_index, quote=False)),
                             'unique': True,
                             'pk': False,
                         }
                     )
 
+            note_parts = []
             if app_table.__doc__:
-                tables[table_name]["note"] += f"\n{app_table.__doc__}"
+                note_parts.append(app_table.__doc__)
 
-            if app_table._meta.db_table_comment:
-                comment = app_table._meta.db_table_comment.replace('"', '\"')
-                tables[table_name]["note"] += f'\n\n*DB comment: {comment}*'
+            if opts.db_table_comment:
+                comment = opts.db_table_comment.replace('"', '\"')
+                note_parts.append(f'*DB comment: {comment}*')
 
-            if not self.options["table_names"]:
-                tables[table_name]["note"] += f"\n\n*DB table: {app_table._meta.db_table}*"
+            if not use_table_names:
+                note_parts.append(f"*DB table: {db_table}*")
 
-        # Generate output string from the collected info
-        output_blocks = []
+            table_entry["note"] = '\n\n'.join(note_parts)
 
-        if not self.options.get('disable_update_timestamp'):
-            ts = datetime.now(UTC).strftime('%m-%d-%Y %I:%M%p UTC')
-            output_blocks += [
-                f'Project "{project_name}" {{\n  database_type: \'{self.get_db_type()}\'\n  Note: \'\'\'{project_notes}\n  Last Updated At {ts}\'\'\'\n}}\n'
-            ]
-        else:
-            output_blocks += [f'Project "{project_name}" {{\n  database_type: \'{self.get_db_type()}\'\n  Note: \'\'\'{project_notes}\'\'\'\n}}\n']
-
-        for enum_name, enum in sorted(enums.items()):
-            output_blocks += [f"enum {enum_name} {{\n  {enum}\n}}\n"]
+        # Generate the output from the collected info.
+        # A file is written as the output is produced, to a temporary file that replaces the target once rendering succeeded.
+        # Output for stdout is collected first and written in one go,
+        # since stdout is line buffered when attached to a terminal and would otherwise be flushed on every line.
 
-        for table_name, table in sorted(tables.items()):
-            if self.options["color_by_app"]:
-                output_blocks += ["Table {} [headercolor: {}] {{".format(table_name, table_colors_and_groups[table_name]["color"])]
-            else:
-                output_blocks += [f"Table {table_name} {{"]
-
-            if table.get('note'):
-                output_blocks += ["  Note: '''\n{}'''\n".format(self.cleanup_docstring(table['note']))]
-
-            for field_name, field in table["fields"].items():
-                output_blocks += ["  {} {} {}".format(field_name, field["type"], self.get_field_attributes(field)).rstrip()]
-            if table.get('indexes'):
-                output_blocks += ['\n  indexes {']
-                for index in sorted(table['indexes'], key=lambda x: str(x['name'])):
-                    fields_as_list = '({})'.format(','.join(index['fields']))
-                    index_attributes = []
-                    if index['pk']:
-                        index_attributes.append('pk')
-                    if index['unique']:
-                        index_attributes.append('unique')
-
-                    index_attributes.append(f"name: '{index['name']}'")  # noqa: FURB113
-                    index_attributes.append(f"type: {index['type']}")
-
-                    index_string = f"{fields_as_list} [{', '.join(index_attributes)}]"
-                    output_blocks += [f'    {index_string}']
-                output_blocks += ['  }']
-            output_blocks += ["}"]
-
-            for relation in table["relations"]:
-                if relation["type"] == "one_to_many":
-                    output_blocks += [
-                        "ref: {}.{} > {}.{}".format(relation["table_to"], relation["table_to_field"], relation["table_from"], relation["table_from_field"])
-                    ]
-
-                if relation["type"] == "one_to_one":
-                    output_blocks += [
-                        "ref: {}.{} - {}.{}".format(relation["table_to"], relation["table_to_field"], relation["table_from"], relation["table_from_field"])
-                    ]
-            output_blocks += ['\n']
-
-        if self.options["group_by_app"]:
-            groups = {}
-            for table_name, group_color_dict in sorted(table_colors_and_groups.items()):
-                group = group_color_dict["group"]
-                if group in groups:
-                    groups[group].append(table_name)
+        output_file = self.options.get('output_file')
+        output = replace_file_on_success(Path(output_file)) if output_file else nullcontext(io.StringIO())
+        with output as out:
+            write = out.write
+
+            project_note = project_notes
+            if not self.options.get('disable_update_timestamp'):
+                ts = datetime.now(UTC).strftime('%m-%d-%Y %I:%M%p UTC')
+                project_note = f'{project_notes}\n  Last Updated At {ts}'
+            write(f'Project "{project_name}" {{\n  database_type: \'{self.get_db_type()}\'\n  Note: \'\'\'{project_note}\'\'\'\n}}\n\n')
+
+            for enum_name, enum in sorted(enums.items()):
+                write(f"enum {enum_name} {{\n  {enum}\n}}\n\n")
+
+            # Tables and table groups are both listed in table name order, so sort the names once
+            sorted_table_names = sorted(tables)
+
+            for table_name in sorted_table_names:
+                table = tables[table_name]
+                # Each table block, including its refs, is assembled as a list of lines and written at once
+                if color_by_app:
+                    lines = [f"Table {table_name} [headercolor: {table_colors[table_name]}] {{"]
                 else:
-                    groups[group] = [table_name]
-
-            for group, tables in sorted(groups.items()):
-                output_blocks += [f"TableGroup {group} {{"]
-                for table in tables:
-                    output_blocks += [f"  {table}"]
-                output_blocks += ["}\n"]
-
-        output_string = '\n'.join(output_blocks)
+                    lines = [f"Table {table_name} {{"]
+
+                note = table['note']
+                if note:
+                    lines.append(f"  Note: '''\n{self.cleanup_docstring(note)}'''\n")
+
+                lines.extend(f"  {field_name} {field['type']} {self.get_field_attributes(field)}".rstrip() for field_name, field in table["fields"].items())
+                if table.get('indexes'):
+                    lines.append('\n  indexes {')
+                    for index in sorted(table['indexes'], key=itemgetter('name')):
+                        fields_as_list = f"({','.join(index['fields'])})"
+                        index_attributes = []
+                        if index['pk']:
+                            index_attributes.append('pk')
+                        if index['unique']:
+                            index_attributes.append('unique')
+
+                        index_attributes.append(f"name: '{index['name']}'")  # noqa: FURB113
+                        index_attributes.append(f"type: {index['type']}")
+
+                        lines.append(f"    {fields_as_list} [{', '.join(index_attributes)}]")
+                    lines.append('  }')
+                lines.append("}")
+
+                lines.extend(
+                    f"ref: {table_to}.{table_to_field} {relation_symbols[relation_type]} {table_from}.{table_from_field}"
+                    for relation_type, table_to, table_to_field, table_from, table_from_field in table["relations"]
+                )
+                write('\n'.join(lines))
+                write('\n\n\n')
+
+            # A table name can come from models in several apps, the last one seen decides its group
+            groups = {}
+            if group_by_app:
+                for table_name in sorted_table_names:
+                    groups.setdefault(table_groups[table_name], []).append(table_name)
 
-        # Output the result either to a file, or to stdout
+            for group, group_table_names in sorted(groups.items()):
+                write(f"TableGroup {group} {{\n")
+                for table_name in group_table_names:
+                    write(f"  {table_name}\n")
+                write("}\n\n")
 
-        output_file = self.options.get('output_file')
         if output_file:
-            with Path(output_file).open('w', encoding="utf-8") as f:
-                f.write(output_string)
             logger.info('Generated dbml file to %s', output_file)
         else:
-            print(output_string)  # noqa: T201
+            self.stdout.write(out.getvalue(), ending='')
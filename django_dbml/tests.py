@@ -1,3 +1,73 @@
-from django.test import TestCase
+from io import StringIO
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import models
+from django.test import SimpleTestCase
+
+from django_dbml.utils import to_snake_case
+
+
+SIZES = [('S', 'Small'), ('L', 'Large')]
+GROUPED_SIZES = [('Sizes', [('S', 'Small'), ('L', 'Large')])]
+
+
+class Shirt(models.Model):
+    size = models.CharField(max_length=1, choices=SIZES)
+    fit = models.CharField(max_length=1, choices=GROUPED_SIZES)
+
+    class Meta:
+        app_label = 'django_dbml'
+
+
+class Jacket(models.Model):
+    size = models.CharField(max_length=1, choices=SIZES)
+    fit = models.CharField(max_length=1, choices=GROUPED_SIZES)
+
+    class Meta:
+        app_label = 'django_dbml'
+
+
+def generate_dbml(*args):
+    stdout = StringIO()
+    call_command('dbml', 'django_dbml', '--disable_update_timestamp', *args, stdout=stdout)
+    return stdout.getvalue()
+
+
+class DeduplicateEnumsTests(SimpleTestCase):
+    def test_shared_choices_use_one_enum(self):
+        output = generate_dbml('--deduplicate_enums')
+
+        self.assertIn('enum django_dbml.char_shirt_size {', output)
+        self.assertNotIn('enum django_dbml.char_jacket_size {', output)
+        self.assertEqual(output.count('  size django_dbml.char_shirt_size [not null]'), 2)
+
+    def test_grouped_choices_keep_their_own_enum(self):
+        output = generate_dbml('--deduplicate_enums')
+
+        self.assertIn('enum django_dbml.char_shirt_fit {', output)
+        self.assertIn('enum django_dbml.char_jacket_fit {', output)
+        self.assertIn('  fit django_dbml.char_shirt_fit [not null]', output)
+        self.assertIn('  fit django_dbml.char_jacket_fit [not null]', output)
+
+    def test_enums_are_not_shared_by_default(self):
+        output = generate_dbml()
+
+        self.assertIn('enum django_dbml.char_shirt_size {', output)
+        self.assertIn('enum django_dbml.char_jacket_size {', output)
+        self.assertIn('  size django_dbml.char_shirt_size [not null]', output)
+        self.assertIn('  size django_dbml.char_jacket_size [not null]', output)
+
+
+class ToSnakeCaseTests(SimpleTestCase):
+    def test_words(self):
+        self.assertEqual(to_snake_case('PositiveSmallInteger'), 'positive_small_integer')
+
+    def test_acronyms_stay_together(self):
+        self.assertEqual(to_snake_case('GenericIPAddress'), 'generic_ip_address')
+        self.assertEqual(to_snake_case('URL'), 'url')
+        self.assertEqual(to_snake_case('UUID'), 'uuid')
+        self.assertEqual(to_snake_case('JSON'), 'json')
+        self.assertEqual(to_snake_case('CIText'), 'ci_text')
+
+    def test_digits(self):
+        self.assertEqual(to_snake_case('Int8Range'), 'int8_range')
@@ -1,11 +1,9 @@
 import re
 
 
-snake_pattern = re.compile(r"(?<!^)(?=[A-Z])")
+# Split camel case words without splitting acronyms, e.g. GenericIPAddress -> Generic_IP_Address
+snake_pattern = re.compile(r"(?<=[a-z0-9])(?=[A-Z])|(?<=[A-Z])(?=[A-Z][a-z])")
 
 
 def to_snake_case(value):
-    value = snake_pattern.sub("_", value).lower()
-    value = value.replace("i_p_", "ip_").replace("u_r_l", "url").replace("u_u_i_d", "uuid").replace("j_s_o_n", "json")
-
-    return value
+    return snake_pattern.sub("_", value).lower()